@@ -1,6 +1,9 @@
 import streamlit as st
 import pandas as pd
 import requests
+import ast
+import json
+from functools import lru_cache
 
 API_URL = "http://localhost:3001"
 
@@ -80,4 +83,113 @@ def obtener_vista_citas_completa_csv():
     
     df_vista['Fecha'] = pd.to_datetime(df_vista['Fecha'], errors='coerce')
     
-    return df_vista
\ No newline at end of file
+    return df_vista
+
+# --- MÉTODO 3: Planes de análisis del Asistente IA (sin exec de código generado) ---
+
+FUNCIONES_AGREGACION = {"sum", "mean", "median", "count", "nunique", "min", "max"}
+PERIODOS_FECHA = {"dia": "D", "semana": "W", "mes": "M"}
+NODOS_FILTRO_PERMITIDOS = (
+    ast.Expression, ast.BoolOp, ast.And, ast.Or, ast.UnaryOp, ast.Not, ast.USub,
+    ast.BinOp, ast.Add, ast.Sub, ast.Mult, ast.Div, ast.BitAnd, ast.BitOr,
+    ast.Compare, ast.Eq, ast.NotEq, ast.Lt, ast.LtE, ast.Gt, ast.GtE, ast.In, ast.NotIn,
+    ast.Name, ast.Load, ast.Constant, ast.List, ast.Tuple,
+)
+
+def _validar_filtro(filtro, columnas):
+    """Acepta solo comparaciones sobre columnas y constantes (nada de llamadas, atributos ni @variables)."""
+    try:
+        arbol = ast.parse(filtro, mode="eval")
+    except SyntaxError:
+        raise ValueError(f"El filtro del plan no es una expresión válida: {filtro}")
+    for nodo in ast.walk(arbol):
+        if not isinstance(nodo, NODOS_FILTRO_PERMITIDOS):
+            raise ValueError(f"El filtro del plan contiene una operación no permitida: {type(nodo).__name__}")
+        if isinstance(nodo, ast.Name) and nodo.id not in columnas:
+            raise ValueError(f"El filtro del plan usa una columna desconocida: {nodo.id}")
+
+@lru_cache(maxsize=128)
+def interpretar_plan(texto_plan, columnas):
+    """Convierte el JSON devuelto por la IA en un plan validado contra las columnas disponibles."""
+    plan = json.loads(texto_plan)
+    if not isinstance(plan, dict):
+        raise ValueError("El plan de análisis debe ser un objeto JSON.")
+
+    filtro = plan.get("filtro") or None
+    if filtro:
+        _validar_filtro(filtro, columnas)
+
+    agrupar_por = plan.get("agrupar_por") or []
+    if isinstance(agrupar_por, str):
+        agrupar_por = [agrupar_por]
+    columnas_resultado = plan.get("columnas") or []
+    for columna in [*agrupar_por, *columnas_resultado]:
+        if columna not in columnas:
+            raise ValueError(f"El plan usa una columna desconocida: {columna}")
+
+    periodo = plan.get("periodo") or None
+    if periodo and periodo not in PERIODOS_FECHA:
+        raise ValueError(f"Periodo no soportado: {periodo}")
+
+    agregaciones = plan.get("agregaciones") or {}
+    for columna, funciones in agregaciones.items():
+        if columna not in columnas:
+            raise ValueError(f"El plan agrega una columna desconocida: {columna}")
+        for funcion in [funciones] if isinstance(funciones, str) else funciones:
+            if funcion not in FUNCIONES_AGREGACION:
+                raise ValueError(f"Función de agregación no permitida: {funcion}")
+
+    ordenar = plan.get("ordenar") or None
+    if ordenar not in (None, "asc", "desc"):
+        raise ValueError(f"Orden no soportado: {ordenar}")
+    limite = plan.get("limite")
+
+    return {
+        "filtro": filtro,
+        "agrupar_por": agrupar_por,
+        "periodo": periodo,
+        "agregaciones": agregaciones,
+        "columnas": columnas_resultado,
+        "ordenar": ordenar,
+        "limite": int(limite) if limite else None,
+    }
+
+def ejecutar_plan(df, plan):
+    """Ejecuta un plan validado con operaciones vectorizadas de Pandas."""
+    if plan["filtro"]:
+        df = df.query(plan["filtro"])
+
+    claves = list(plan["agrupar_por"])
+    if plan["periodo"]:
+        claves.append(df["Fecha"].dt.to_period(PERIODOS_FECHA[plan["periodo"]]).astype(str).rename("Periodo"))
+
+    if plan["agregaciones"] and claves:
+        grupos = df.groupby(claves, observed=True)
+        # Una clave de agrupación no se agrega sobre sí misma: su "count" es el tamaño de cada
+        # grupo (columna <clave>_count) y el resto de funciones sobre ella se omiten.
+        agregaciones = {columna: funciones for columna, funciones in plan["agregaciones"].items() if columna not in plan["agrupar_por"]}
+        resultado = grupos.agg(agregaciones) if agregaciones else pd.DataFrame(index=grupos.size().index)
+        if isinstance(resultado.columns, pd.MultiIndex):
+            resultado.columns = ["_".join(columna) for columna in resultado.columns]
+        for columna, funciones in plan["agregaciones"].items():
+            if columna in plan["agrupar_por"] and "count" in ([funciones] if isinstance(funciones, str) else funciones):
+                resultado[f"{columna}_count"] = grupos.size()
+    elif plan["agregaciones"]:
+        # Sin agrupación el resultado es una sola fila con una columna por agregación
+        resultado = df.agg(plan["agregaciones"])
+        if isinstance(resultado, pd.DataFrame):
+            resultado = resultado.unstack().dropna()
+            resultado.index = ["_".join(columna) for columna in resultado.index]
+        resultado = resultado.to_frame().T.reset_index(drop=True)
+    else:
+        resultado = df[plan["columnas"]] if plan["columnas"] else df
+
+    if plan["ordenar"]:
+        ascendente = plan["ordenar"] == "asc"
+        if isinstance(resultado, pd.DataFrame) and not resultado.empty:
+            resultado = resultado.sort_values(resultado.columns[0], ascending=ascendente)
+        elif isinstance(resultado, pd.Series):
+            resultado = resultado.sort_values(ascending=ascendente)
+    if plan["limite"]:
+        resultado = resultado.head(plan["limite"])
+    return resultado
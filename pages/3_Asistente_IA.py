@@ -1,11 +1,15 @@
 import streamlit as st
 import pandas as pd
-from data_manager import obtener_vista_citas_completa
-from report_generator import generar_pdf_reporte
+import numpy as np
+from data_manager import obtener_vista_citas_completa, interpretar_plan, ejecutar_plan
+from report_generator import generar_pdf_reporte, generar_pdf_reporte_base, completar_pdf_reporte, crear_graficos
 import google.generativeai as genai
-import traceback
-from io import StringIO
-import sys
+import asyncio
+import threading
+import json
+import io
+import zipfile
+import logging
 from PIL import Image
 
 # --- Configuración de la Página ---
@@ -16,7 +20,18 @@ st.markdown("Tu centro de mando para análisis avanzados, reportes y marketing i
 # --- Cargar y cachear los datos desde la API ---
 @st.cache_data
 def cargar_datos():
-    return obtener_vista_citas_completa()
+    # 'Fecha' ya llega como datetime desde obtener_vista_citas_completa; el día de la
+    # semana se precalcula aquí para que quede en caché junto con el resto de los datos.
+    df = obtener_vista_citas_completa()
+    if df.empty:
+        return df
+    # Ordenado por fecha (NaT al final) para poder recortar rangos recientes con searchsorted
+    df = df.sort_values('Fecha', kind='stable').reset_index(drop=True)
+    df['Fecha_day_name'] = df['Fecha'].dt.day_name()
+    # Columnas de texto repetitivas como 'category': los filtros por igualdad comparan códigos enteros
+    for columna in ['Nombre_Sede', 'Nombre_Completo_Barbero', 'Nombre_Servicio', 'Nombre_Completo_Cliente', 'Fecha_day_name']:
+        df[columna] = df[columna].astype('category')
+    return df
 
 df_citas_completa = cargar_datos()
 
@@ -24,24 +39,34 @@ if df_citas_completa.empty:
     st.error("No se pudieron cargar los datos desde la API. Asegúrate de que la API (index.js) esté corriendo.")
     st.stop()
 
+# --- Logging configurado una sola vez por proceso (no en cada rerun) ---
+@st.cache_resource
+def obtener_logger():
+    logging.basicConfig(level=logging.WARNING, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    return logging.getLogger("asistente_ia")
+
+logger = obtener_logger()
+
 # --- Conexión al API de Gemini con el modelo correcto ---
-model = None
-try:
+MODELO_GEMINI = 'gemini-2.5-flash-preview-05-20'
+# Se cachea como recurso para no reconfigurar el cliente en cada rerun de Streamlit
+@st.cache_resource
+def obtener_modelo():
     api_key = st.secrets["GOOGLE_API_KEY"]
     genai.configure(api_key=api_key)
     # --- LA SOLUCIÓN DEFINITIVA: Usamos un nombre de la lista que nos dio el diagnóstico ---
-    model = genai.GenerativeModel('gemini-2.5-flash-preview-05-20')
+    return genai.GenerativeModel(MODELO_GEMINI)
+
+model = None
+try:
+    model = obtener_modelo()
 except Exception as e:
     st.error(f"No se pudo configurar la conexión con Google Gemini. Verifica tu API Key. Error: {e}")
 
-# --- Función para generar análisis de reportes ---
-def generar_analisis_ia_con_gemini(datos_filtrados_str):
-    if not model: return "El modelo de IA no está disponible."
-    try:
-        prompt = f"""
+# --- Instrucciones fijas de cada asistente (solo la parte variable viaja en cada petición) ---
+INSTRUCCIONES_REPORTE = """
 Actúa como un analista de datos y estratega de negocios experto para la cadena de barberías, Kingdom Barber.
-A continuación, tu análisis debe basarse en esta lista de objetos.
-Datos: {datos_filtrados_str}
+Tu análisis debe basarse en el resumen en JSON de las citas filtradas que recibirás (totales y agregados por sede, servicio, barbero y día).
 
 Proporciona un análisis siguiendo esta estructura exacta:
 1. **Resumen Ejecutivo:** Un buen párrafo con los 2 hallazgos más importantes basado en los filtros aplicados. Cuantifica el hallazgo principal (ej. "el 60% de los ingresos...").
@@ -50,37 +75,196 @@ Proporciona un análisis siguiendo esta estructura exacta:
 
 El tono debe ser profesional y orientado a la acción. Basa el 100% de tu análisis estrictamente en los datos proporcionados y filtrados. No inventes información, eres profesional.
 """
-        response = model.generate_content(prompt)
+
+INSTRUCCIONES_AGENTE = """
+Actúa como un Agente de IA experto en análisis de datos con Pandas.
+Tu objetivo es diseñar un plan de análisis para responder la pregunta del usuario sobre un DataFrame de citas.
+
+**Contexto del DataFrame:**
+- Contiene datos de citas de una barbería.
+- 'Precio' representa ingresos.
+- 'Fecha' es crucial para análisis de tiempo; 'Fecha_day_name' es el día de la semana (en inglés).
+- 'Nombre_Completo_Barbero' y 'Nombre_Completo_Cliente' identifican a las personas.
+
+**Reglas Estrictas:**
+1.  **SOLO JSON:** Tu única respuesta debe ser un objeto JSON con este formato, sin explicaciones:
+    {"filtro": null, "agrupar_por": [], "periodo": null, "agregaciones": {}, "columnas": [], "ordenar": null, "limite": null}
+2.  **filtro:** Expresión de `DataFrame.query` usando solo nombres de columnas, constantes, comparaciones, `in`, `and`, `or` y `not` (ej. `Precio > 20000 and Fecha >= "2025-03-01"`). Usa null si no hace falta.
+3.  **agrupar_por:** Lista de columnas para agrupar. **periodo:** "dia", "semana" o "mes" para agrupar por fecha, o null.
+4.  **agregaciones:** Objeto columna -> función (o lista de funciones) entre "sum", "mean", "median", "count", "nunique", "min" y "max".
+5.  **columnas:** Solo si no hay agregaciones, las columnas a mostrar de las filas filtradas.
+6.  **ordenar:** "asc", "desc" o null (ordena por la primera columna del resultado). **limite:** Número de filas a devolver o null.
+"""
+
+INSTRUCCIONES_INTERPRETE = """
+Eres "Alex", un asistente de datos amigable. Responde la pregunta del usuario de forma clara y directa, basándote en el resultado del análisis.
+
+**Tu Respuesta Final:**
+Empieza con una respuesta directa. Luego, si es apropiado, añade un breve contexto o explicación.
+"""
+
+INSTRUCCIONES_MARKETING = """
+Actúa como un Director Creativo y Estratega de Marketing para la barbería 'Kingdom Barber'.
+Tu tarea es crear un borrador para una campaña de marketing a partir de los inputs estratégicos que recibirás.
+
+**OUTPUT REQUERIDO (Formato Markdown):**
+Usa un tono creativo, masculino y directo.
+
+###  Nombre de la Campaña
+- **Slogan:** Un eslogan corto y pegadizo.
+- **Público Objetivo:** ¿A quién nos dirigimos principalmente?
+- **Mensaje para el Canal de Difusión:** Escribe el texto exacto para el post, email o mensaje de WhatsApp. Debe ser conciso y persuasivo.
+- **Llamada a la Acción (CTA):** ¿Qué queremos que haga el cliente?
+- **Sugerencia Creativa:** Una idea adicional (ej. un hashtag, tipo de imagen, colaboración).
+"""
+
+INSTRUCCIONES_OPORTUNIDADES = """Eres un estratega de negocios para barberías. Analiza los datos clave y las áreas de interés. Para CADA área, proporciona: 1. **Hallazgo Principal**. 2. **Oportunidad Estratégica**. 3. **Acción Concreta**. Usa Markdown."""
+
+INSTRUCCIONES_ASESOR = """
+Actúa como un estilista de élite y experto en visagismo masculino. Tu cliente te ha mostrado una foto para que le des una asesoría de imagen completa.
+
+**Tu Tarea (formato Markdown):**
+1.  **Diagnóstico del Rostro:** Primero, identifica la forma del rostro (ej. Ovalado, Cuadrado, Redondo, etc.).
+2.  **Recomendaciones de Cortes (Top 3):**
+    - **Nombre del Estilo:** (ej. Pompadour Clásico, Buzz Cut, Quiff Texturizado).
+    - **¿Por qué te favorece?:** Explica brevemente cómo el corte complementa la forma del rostro.
+    - **Nivel de Mantenimiento:** (Bajo, Medio, Alto).
+    - **Productos Recomendados:** Sugiere un tipo de producto ideal (ej. Cera mate, pomada base agua, spray de sal marina).
+    - **Inspiración Visual:** Proporciona un enlace de búsqueda de Google Images para que el cliente vea ejemplos. Usa el formato: `[Ver Ejemplos](https://www.google.com/search?q=...&tbm=isch)`
+
+Sé profesional, alentador y específico en tus recomendaciones.
+"""
+
+# --- Un modelo por plantilla, con sus instrucciones fijas como system_instruction ---
+# (Las instrucciones son demasiado cortas para la caché de contexto de Gemini, que exige un mínimo de tokens.)
+@st.cache_resource(show_spinner=False)
+def obtener_modelo_con_instrucciones(instrucciones):
+    return genai.GenerativeModel(MODELO_GEMINI, system_instruction=instrucciones)
+
+# --- Transmite la respuesta de Gemini fragmento a fragmento para st.write_stream ---
+def transmitir_texto(respuesta):
+    for fragmento in respuesta:
+        yield fragmento.text
+
+# --- Bucle de eventos persistente para las llamadas asíncronas a Gemini ---
+# El cliente asíncrono de Gemini queda ligado al primer bucle que lo usa, así que
+# no se crea uno nuevo con asyncio.run() en cada rerun de Streamlit.
+@st.cache_resource
+def obtener_bucle_eventos():
+    bucle = asyncio.new_event_loop()
+    threading.Thread(target=bucle.run_forever, daemon=True).start()
+    return bucle
+
+def ejecutar_async(corrutina):
+    return asyncio.run_coroutine_threadsafe(corrutina, obtener_bucle_eventos()).result()
+
+# --- Función para generar análisis de reportes ---
+# Corre en el hilo del bucle de eventos, sin contexto de Streamlit: el modelo se obtiene
+# en el hilo del script y llega como argumento. Devuelve None si la IA no respondió.
+async def generar_analisis_ia_con_gemini(modelo_reporte, datos_filtrados_str):
+    if not modelo_reporte: return None
+    try:
+        response = await modelo_reporte.generate_content_async(f"Datos: {datos_filtrados_str}")
         return response.text
-    except Exception as e:
-        traceback.print_exc()
-        return "No se pudo generar el análisis debido a un error de conexión con la IA."
+    except Exception:
+        logger.exception("Error al generar el análisis del reporte con Gemini")
+        return None
+
+MENSAJE_SIN_ANALISIS = "No se pudo generar el análisis debido a un error de conexión con la IA."
+
+# --- Arma el PDF mientras la IA responde: portada, tablas y gráficos no dependen del análisis ---
+async def preparar_reporte(modelo_reporte, df, datos_filtrados_str, contexto_reporte):
+    tarea_analisis = asyncio.create_task(generar_analisis_ia_con_gemini(modelo_reporte, datos_filtrados_str))
+    pdf, graficos = await asyncio.gather(
+        asyncio.to_thread(generar_pdf_reporte_base, df, contexto_reporte),
+        asyncio.to_thread(crear_graficos, df),
+    )
+    analisis_ia = await tarea_analisis
+    pdf_bytes = await asyncio.to_thread(completar_pdf_reporte, pdf, df, analisis_ia or MENSAJE_SIN_ANALISIS, graficos)
+    return pdf_bytes, analisis_ia is not None
+
+# --- Lanza el análisis de todas las sedes a la vez (reporte masivo) ---
+async def generar_analisis_por_sede(modelo_reporte, datos_por_sede):
+    analisis = await asyncio.gather(*(generar_analisis_ia_con_gemini(modelo_reporte, datos) for datos in datos_por_sede.values()))
+    return dict(zip(datos_por_sede, analisis))
+
+# --- Opciones de los filtros: solo dependen de los datos cacheados, no de cada rerun ---
+@st.cache_data
+def obtener_opciones_filtros(_df):
+    sedes = ["Todas"] + sorted(_df['Nombre_Sede'].dropna().unique().tolist())
+    barberos = ["Todos"] + sorted(_df['Nombre_Completo_Barbero'].dropna().unique().tolist())
+    servicios = ["Todos"] + sorted(_df['Nombre_Servicio'].dropna().unique().tolist())
+    fechas_validas = _df['Fecha'].dropna()
+    min_date = fechas_validas.min().date() if not fechas_validas.empty else pd.Timestamp.now().date()
+    max_date = fechas_validas.max().date() if not fechas_validas.empty else pd.Timestamp.now().date()
+    if min_date > max_date: min_date = max_date
+    return sedes, barberos, servicios, min_date, max_date
 
 # --- Barra Lateral de Filtros ---
 with st.sidebar:
     st.header("Filtros para el Reporte")
-    df_citas_completa['Fecha'] = pd.to_datetime(df_citas_completa['Fecha'], errors='coerce')
-    sedes_disponibles = ["Todas"] + df_citas_completa['Nombre_Sede'].dropna().unique().tolist()
+    sedes_disponibles, barberos_disponibles, servicios_disponibles, min_date, max_date = obtener_opciones_filtros(df_citas_completa)
     sede_seleccionada = st.selectbox("Selecciona una Sede", sedes_disponibles)
-    fechas_validas = df_citas_completa['Fecha'].dropna()
-    min_date = fechas_validas.min().date() if not fechas_validas.empty else pd.Timestamp.now().date()
-    max_date = fechas_validas.max().date() if not fechas_validas.empty else pd.Timestamp.now().date()
-    if min_date > max_date: min_date = max_date
     rango_fechas = st.date_input("Selecciona un Rango de Fechas", value=(min_date, max_date), min_value=min_date, max_value=max_date)
-    barberos_disponibles = ["Todos"] + sorted(df_citas_completa['Nombre_Completo_Barbero'].dropna().unique().tolist())
     barbero_seleccionado = st.selectbox("Selecciona un Barbero", barberos_disponibles)
-    servicios_disponibles = ["Todos"] + sorted(df_citas_completa['Nombre_Servicio'].dropna().unique().tolist())
     servicio_seleccionado = st.selectbox("Selecciona un Servicio", servicios_disponibles)
 
-# --- Aplicar filtros a los datos ---
-df_filtrado = df_citas_completa.copy()
-if sede_seleccionada != "Todas": df_filtrado = df_filtrado[df_filtrado['Nombre_Sede'] == sede_seleccionada]
-if len(rango_fechas) == 2:
-    fecha_inicio, fecha_fin = pd.to_datetime(rango_fechas[0]), pd.to_datetime(rango_fechas[1])
-    df_filtrado = df_filtrado.dropna(subset=['Fecha'])
-    df_filtrado = df_filtrado[(df_filtrado['Fecha'] >= fecha_inicio) & (df_filtrado['Fecha'] <= fecha_fin)]
-if barbero_seleccionado != "Todos": df_filtrado = df_filtrado[df_filtrado['Nombre_Completo_Barbero'] == barbero_seleccionado]
-if servicio_seleccionado != "Todos": df_filtrado = df_filtrado[df_filtrado['Nombre_Servicio'] == servicio_seleccionado]
+# --- Aplicar filtros a los datos (una sola máscara combinada, un solo recorte) ---
+# El DataFrame va con guion bajo para que Streamlit no lo hashee en cada rerun:
+# es el resultado cacheado de cargar_datos y la clave la forman los filtros.
+@st.cache_data(max_entries=32)
+def filtrar_citas(_df, sede, rango_fechas, barbero, servicio):
+    mascara = np.ones(len(_df), dtype=bool)
+    if sede != "Todas": mascara &= (_df['Nombre_Sede'] == sede).to_numpy()
+    if len(rango_fechas) == 2:
+        fecha_inicio, fecha_fin = pd.to_datetime(rango_fechas[0]), pd.to_datetime(rango_fechas[1])
+        # between() ya descarta las fechas NaT, así que no hace falta un dropna previo
+        mascara &= _df['Fecha'].between(fecha_inicio, fecha_fin).to_numpy()
+    if barbero != "Todos": mascara &= (_df['Nombre_Completo_Barbero'] == barbero).to_numpy()
+    if servicio != "Todos": mascara &= (_df['Nombre_Servicio'] == servicio).to_numpy()
+    return _df.loc[mascara]
+
+# --- Resumen agregado (en vez de filas crudas) para el prompt del reporte ---
+@st.cache_data(max_entries=32)
+def serializar_para_ia(_df_filtrado, filtros):
+    def ingresos_por(columna):
+        return _df_filtrado.groupby(columna, observed=True)['Precio'].agg(['sum', 'count']).to_dict(orient='index')
+    resumen = {
+        "totales": {"citas": len(_df_filtrado), "ingresos": float(_df_filtrado['Precio'].sum()), "ticket_promedio": float(_df_filtrado['Precio'].mean())},
+        "por_sede": ingresos_por('Nombre_Sede'),
+        "por_servicio": ingresos_por('Nombre_Servicio'),
+        "por_barbero": ingresos_por('Nombre_Completo_Barbero'),
+        "ingresos_por_dia": _df_filtrado.groupby(_df_filtrado['Fecha'].dt.strftime('%Y-%m-%d'))['Precio'].sum().to_dict(),
+    }
+    return json.dumps(resumen, ensure_ascii=False, separators=(',', ':'), default=str)
+
+filtros = (sede_seleccionada, tuple(rango_fechas), barbero_seleccionado, servicio_seleccionado)
+df_filtrado = filtrar_citas(df_citas_completa, *filtros)
+
+# --- Columnas que necesita cada pestaña (IDs, teléfonos y correos no salen de aquí) ---
+COLS_REPORTE = ['Fecha', 'Nombre_Sede', 'Nombre_Completo_Barbero', 'Nombre_Servicio', 'Precio']
+# send_message reenvía todo el historial: del chat del analista se conservan el primer turno
+# (columnas y tipos) y solo estas últimas preguntas, para que cada envío no crezca sin límite
+TURNOS_RECIENTES_CHAT_ANALISTA = 2
+COLS_ANALISTA = ['Fecha', 'Fecha_day_name', 'Hora', 'Nombre_Sede', 'Nombre_Completo_Barbero', 'Nombre_Completo_Cliente', 'Nombre_Servicio', 'Precio', 'Duracion_min']
+
+def proyectar_columnas(df, columnas):
+    return df[[columna for columna in columnas if columna in df.columns]]
+
+# --- Categoría con menos apariciones (entre las presentes), contando códigos con bincount ---
+def categoria_menos_frecuente(serie):
+    codigos = serie.cat.codes.to_numpy()
+    conteos = np.bincount(codigos[codigos >= 0], minlength=len(serie.cat.categories))
+    presentes = np.flatnonzero(conteos)
+    return serie.cat.categories[presentes[conteos[presentes].argmin()]]
+
+# --- Reduce la foto a la resolución que aprovecha el modelo y la envía como JPEG en línea ---
+def preparar_imagen_para_ia(imagen, lado_maximo=768):
+    imagen = imagen.convert('RGB')  # convert() devuelve una copia: la imagen mostrada no cambia
+    imagen.thumbnail((lado_maximo, lado_maximo), Image.LANCZOS)
+    buffer = io.BytesIO()
+    imagen.save(buffer, 'JPEG', quality=85, optimize=True)
+    return {"mime_type": "image/jpeg", "data": buffer.getvalue()}
 
 # --- Interfaz Principal con Pestañas ---
 tab_reportes, tab_analista, tab_marketing, tab_oportunidades, tab_asesor = st.tabs([
@@ -95,18 +279,46 @@ with tab_reportes:
         if df_filtrado.empty:
             st.warning("No hay datos para los filtros seleccionados.")
         else:
-            with st.spinner("Preparando datos y consultando a la IA... 🤖"):
-                analisis_ia = generar_analisis_ia_con_gemini(df_filtrado.head(50).to_string())
-            with st.spinner("Creando el archivo PDF... 📄"):
-                contexto_reporte = {"sede": sede_seleccionada, "rango_fechas": f"{rango_fechas[0].strftime('%d/%m/%Y')} - {rango_fechas[1].strftime('%d/%m/%Y')}", "barbero": barbero_seleccionado, "servicio": servicio_seleccionado}
-                pdf_bytes = generar_pdf_reporte(df_filtrado, analisis_ia, contexto_reporte)
-            st.success("¡Reporte generado con éxito!")
+            contexto_reporte = {"sede": sede_seleccionada, "rango_fechas": f"{rango_fechas[0].strftime('%d/%m/%Y')} - {rango_fechas[1].strftime('%d/%m/%Y')}", "barbero": barbero_seleccionado, "servicio": servicio_seleccionado}
+            with st.spinner("Consultando a la IA y creando el archivo PDF... 🤖📄"):
+                modelo_reporte = obtener_modelo_con_instrucciones(INSTRUCCIONES_REPORTE) if model else None
+                df_reporte = proyectar_columnas(df_filtrado, COLS_REPORTE)
+                pdf_bytes, con_analisis = ejecutar_async(preparar_reporte(modelo_reporte, df_reporte, serializar_para_ia(df_reporte, filtros), contexto_reporte))
+            if con_analisis:
+                st.success("¡Reporte generado con éxito!")
+            else:
+                st.warning("El reporte se generó sin el análisis de IA: no se pudo obtener respuesta del modelo.")
             st.download_button(label="📥 Descargar Reporte PDF", data=pdf_bytes, file_name=f"Reporte_{sede_seleccionada.replace(' ', '_')}.pdf", mime="application/pdf")
 
+    st.divider()
+    st.markdown("¿Necesitas el reporte de cada sede? Genéralos todos de una vez (mismos filtros de fecha, barbero y servicio) en un archivo ZIP.")
+    if st.button("🗂️ Generar Reportes de Todas las Sedes"):
+        citas_por_sede = {sede: proyectar_columnas(filtrar_citas(df_citas_completa, sede, *filtros[1:]), COLS_REPORTE) for sede in df_citas_completa['Nombre_Sede'].dropna().unique()}
+        citas_por_sede = {sede: df_sede for sede, df_sede in citas_por_sede.items() if not df_sede.empty}
+        if not citas_por_sede:
+            st.warning("No hay datos para los filtros seleccionados.")
+        else:
+            with st.spinner(f"Consultando a la IA para {len(citas_por_sede)} sedes... 🤖"):
+                modelo_reporte = obtener_modelo_con_instrucciones(INSTRUCCIONES_REPORTE) if model else None
+                datos_por_sede = {sede: serializar_para_ia(df_sede, (sede, *filtros[1:])) for sede, df_sede in citas_por_sede.items()}
+                analisis_por_sede = ejecutar_async(generar_analisis_por_sede(modelo_reporte, datos_por_sede))
+            with st.spinner("Creando los archivos PDF... 📄"):
+                zip_buffer = io.BytesIO()
+                with zipfile.ZipFile(zip_buffer, "w", zipfile.ZIP_DEFLATED) as archivo_zip:
+                    for sede, df_sede in citas_por_sede.items():
+                        contexto_reporte = {"sede": sede, "rango_fechas": f"{rango_fechas[0].strftime('%d/%m/%Y')} - {rango_fechas[1].strftime('%d/%m/%Y')}", "barbero": barbero_seleccionado, "servicio": servicio_seleccionado}
+                        archivo_zip.writestr(f"Reporte_{sede.replace(' ', '_')}.pdf", generar_pdf_reporte(df_sede, analisis_por_sede[sede] or MENSAJE_SIN_ANALISIS, contexto_reporte))
+            sedes_sin_analisis = [sede for sede, analisis in analisis_por_sede.items() if analisis is None]
+            if sedes_sin_analisis:
+                st.warning(f"{len(sedes_sin_analisis)} de {len(citas_por_sede)} reportes se generaron sin el análisis de IA: {', '.join(sedes_sin_analisis)}.")
+            else:
+                st.success(f"¡{len(citas_por_sede)} reportes generados con éxito!")
+            st.download_button(label="📥 Descargar Reportes (ZIP)", data=zip_buffer.getvalue(), file_name="Reportes_Sedes.zip", mime="application/zip")
+
 with tab_analista:
     # (El resto de las pestañas no requieren cambios, sus prompts ya estaban mejorados)
     st.header("🕵️ Chatea con tus Datos")
-    st.info(f"Tengo acceso a las **{len(df_filtrado)} citas** que coinciden con tus filtros. Hazme cualquier pregunta y generaré el código para encontrar la respuesta.")
+    st.info(f"Tengo acceso a las **{len(df_filtrado)} citas** que coinciden con tus filtros. Hazme cualquier pregunta y generaré un plan de análisis para encontrar la respuesta.")
     pregunta_usuario = st.text_input("Escribe tu pregunta aquí:", placeholder="Ej: ¿Cuál es el servicio que generó menos ingresos?")
     if st.button("🤖 Analizar y Responder"):
         if not model: st.error("No puedo conectarme con mi motor de IA.")
@@ -114,60 +326,60 @@ with tab_analista:
         elif df_filtrado.empty: st.warning("No hay datos disponibles para los filtros seleccionados.")
         else:
             with st.spinner("Generando plan de análisis... 🧠"):
-                columnas = df_filtrado.columns.tolist()
-                tipos_de_datos = df_filtrado.dtypes.to_string()
-                prompt_agente = f"""
-                Actúa comoun Agente de IA experto en análisis de datos con Pandas.
-                Tu objetivo es generar un script de Python para responder la pregunta del usuario analizando un DataFrame llamado `df`.
-                
-                **Contexto del DataFrame `df`:**
-                - Contiene datos de citas de una barbería.
-                - 'Precio' representa ingresos.
-                - 'Fecha' es crucial para análisis de tiempo.
-                - 'Nombre_Completo_Barbero' y 'Nombre_Completo_Cliente' identifican a las personas.
-
-                **Reglas Estrictas:**
-                1.  **SOLO CÓDIGO:** Tu única respuesta debe ser un bloque de código Python. No incluyas explicaciones, solo el código.
-                2.  **USA `df`:** El DataFrame a analizar SIEMPRE se llama `df`.
-                3.  **CÓDIGO CLARO:** Añade comentarios breves en el código para explicar los pasos.
-                4.  **IMPRIME EL RESULTADO:** El código DEBE terminar con una línea `print(resultado)` que muestre la respuesta final de forma clara.
-
-                **Información del DataFrame disponible:**
-                - COLUMNAS: {columnas}
-                - TIPOS DE DATOS: {tipos_de_datos}
-
-                **Pregunta del Usuario a Responder:**
-                "{pregunta_usuario}"
-                """
+                df_analista = proyectar_columnas(df_filtrado, COLS_ANALISTA)
                 try:
-                    respuesta_ia = model.generate_content(prompt_agente)
-                    codigo_generado = respuesta_ia.text.strip().replace("```python", "").replace("```", "")
-                    with st.expander("🔍 Ver el Plan de Análisis (código generado)"):
-                        st.code(codigo_generado, language='python')
+                    # Una conversación por sesión: las preguntas siguientes reutilizan el contexto ya enviado.
+                    # Se saca de la sesión mientras se usa y solo se guarda de nuevo cuando el plan llegó
+                    # completo: un rerun o un error a mitad del stream dejan una conversación nueva.
+                    modelo_agente = obtener_modelo_con_instrucciones(INSTRUCCIONES_AGENTE)
+                    chat = st.session_state.pop('chat_analista', None)
+                    if chat is None or chat.model is not modelo_agente or st.session_state.get('filtros_chat_analista') != filtros:
+                        chat = modelo_agente.start_chat()
+                        st.session_state.filtros_chat_analista = filtros
+                    if len(chat.history) > 2 * (1 + TURNOS_RECIENTES_CHAT_ANALISTA):
+                        chat.history = chat.history[:2] + chat.history[-2 * TURNOS_RECIENTES_CHAT_ANALISTA:]
+                    if chat.history:
+                        prompt_agente = f'**Nueva Pregunta del Usuario a Responder:**\n"{pregunta_usuario}"'
+                    else:
+                        columnas = df_analista.columns.tolist()
+                        tipos_de_datos = df_analista.dtypes.to_string()
+                        prompt_agente = f"""
+                        **Información del DataFrame disponible:**
+                        - COLUMNAS: {columnas}
+                        - TIPOS DE DATOS: {tipos_de_datos}
+
+                        **Pregunta del Usuario a Responder:**
+                        "{pregunta_usuario}"
+                        """
+                    with st.expander("🔍 Ver el Plan de Análisis (JSON generado)", expanded=True):
+                        respuesta_ia = st.write_stream(transmitir_texto(chat.send_message(prompt_agente, stream=True)))
+                    st.session_state.chat_analista = chat
+                    texto_plan = respuesta_ia.strip().replace("```json", "").replace("```", "").strip()
                     with st.spinner("Ejecutando el análisis... ⚙️"):
-                        df = df_filtrado
-                        old_stdout, sys.stdout = sys.stdout, StringIO()
-                        exec(codigo_generado, {'pd': pd, 'df': df})
-                        resultado_analisis = sys.stdout.getvalue()
-                        sys.stdout = old_stdout
+                        plan = interpretar_plan(texto_plan, tuple(df_analista.columns))
+                        resultado = ejecutar_plan(df_analista, plan)
+                        if isinstance(resultado, pd.Series):
+                            resultado = resultado.to_frame()
+                        if isinstance(resultado, pd.DataFrame):
+                            resultado = resultado.head(50)
+                            # Solo un índice con nombre trae claves de agrupación; los números de fila no aportan nada
+                            if any(nombre is not None for nombre in resultado.index.names):
+                                resultado = resultado.reset_index()
+                            resultado_analisis = resultado.to_json(orient='records', date_format='iso', force_ascii=False)
+                        else:
+                            resultado_analisis = str(resultado)
                     with st.spinner("Interpretando los resultados... 🗣️"):
                         prompt_interprete = f"""
-                        Eres "Alex", un asistente de datos amigable. Responde la pregunta del usuario de forma clara y directa, basándote en el resultado del análisis.
-                        
                         **Pregunta Original del Usuario:**
                         "{pregunta_usuario}"
                         
-                        **Resultado del Código (Datos Crudos):**
+                        **Resultado del Análisis (registros JSON):**
                         ---
                         {resultado_analisis}
                         ---
-                        
-                        **Tu Respuesta Final:**
-                        Empieza con una respuesta directa. Luego, si es apropiado, añade un breve contexto o explicación.
                         """
-                        respuesta_final_ia = model.generate_content(prompt_interprete)
                         st.markdown("### 💡 Aquí está tu análisis:")
-                        st.success(respuesta_final_ia.text)
+                        st.write_stream(transmitir_texto(obtener_modelo_con_instrucciones(INSTRUCCIONES_INTERPRETE).generate_content(prompt_interprete, stream=True)))
                 except Exception as e:
                     st.error("¡Oops! Ocurrió un error al procesar tu pregunta.")
                     st.exception(e)
@@ -186,33 +398,19 @@ with tab_marketing:
         else:
             with st.spinner("Creando una campaña brillante... ✨"):
                 try:
-                    servicio_menos_popular = df_filtrado['Nombre_Servicio'].value_counts().idxmin()
-                    dia_mas_flojo = df_filtrado['Fecha'].dt.day_name().value_counts().idxmin()
+                    servicio_menos_popular = categoria_menos_frecuente(df_filtrado['Nombre_Servicio'])
+                    dia_mas_flojo = categoria_menos_frecuente(df_filtrado['Fecha_day_name'])
                 except Exception:
                     servicio_menos_popular, dia_mas_flojo = "N/A", "N/A"
                 prompt_marketing = f"""
-                Actúa como un Director Creativo y Estratega de Marketing para la barbería 'Kingdom Barber'.
-                Tu tarea es crear un borrador para una campaña de marketing.
-                
                 **INPUTS ESTRATÉGICOS:**
                 - **Objetivo Principal:** {tipo_campaña}
                 - **Canal de Difusión:** {canal_comunicacion}
                 - **Insight de Datos 1 (Servicio a Potenciar):** {servicio_menos_popular}
                 - **Insight de Datos 2 (Día de Baja Afluencia):** {dia_mas_flojo}
-
-                **OUTPUT REQUERIDO (Formato Markdown):**
-                Usa un tono creativo, masculino y directo.
-                
-                ###  Nombre de la Campaña
-                - **Slogan:** Un eslogan corto y pegadizo.
-                - **Público Objetivo:** ¿A quién nos dirigimos principalmente?
-                - **Mensaje para {canal_comunicacion}:** Escribe el texto exacto para el post, email o mensaje de WhatsApp. Debe ser conciso y persuasivo.
-                - **Llamada a la Acción (CTA):** ¿Qué queremos que haga el cliente?
-                - **Sugerencia Creativa:** Una idea adicional (ej. un hashtag, tipo de imagen, colaboración).
                 """
                 try:
-                    respuesta_ia = model.generate_content(prompt_marketing)
-                    st.markdown(respuesta_ia.text)
+                    st.write_stream(transmitir_texto(obtener_modelo_con_instrucciones(INSTRUCCIONES_MARKETING).generate_content(prompt_marketing, stream=True)))
                 except Exception as e:
                     st.error(f"Ocurrió un error al generar la campaña: {e}")
 
@@ -226,19 +424,22 @@ with tab_oportunidades:
         else:
             with st.spinner("Buscando insights valiosos... 💎"):
                 try:
-                    df_filtrado['Fecha'] = pd.to_datetime(df_filtrado['Fecha'])
                     datos_clave_str = ""
                     try:
                         fecha_maxima = df_filtrado['Fecha'].max()
-                        clientes_recientes = df_filtrado[df_filtrado['Fecha'] > (fecha_maxima - pd.Timedelta(days=90))]
+                        # df_filtrado conserva el orden por fecha de cargar_datos: dos búsquedas binarias
+                        # delimitan los últimos 90 días sin recorrer toda la columna (las NaT quedan al final)
+                        inicio = df_filtrado['Fecha'].searchsorted(fecha_maxima - pd.Timedelta(days=90), side='right')
+                        fin = df_filtrado['Fecha'].searchsorted(fecha_maxima, side='right')
+                        clientes_recientes = df_filtrado.iloc[inicio:fin]
                         todos_los_clientes = df_filtrado['Nombre_Completo_Cliente'].dropna().unique()
-                        clientes_recientes_unicos = clientes_recientes['Nombre_Completo_Cliente'].dropna().unique()
+                        # Un set hace la pertenencia O(1) en lugar de recorrer el arreglo por cada cliente
+                        clientes_recientes_unicos = set(clientes_recientes['Nombre_Completo_Cliente'].dropna().unique())
                         clientes_en_riesgo = [c for c in todos_los_clientes if c and c not in clientes_recientes_unicos]
                         datos_clave_str += f"- Clientes en Riesgo (no visitan en 90 días): {len(clientes_en_riesgo)}.\n"
                     except Exception: pass
-                    prompt_oportunidad = f"""Eres un estratega de negocios para barberías. Analiza los datos clave y las áreas de interés. Para CADA área, proporciona: 1. **Hallazgo Principal**. 2. **Oportunidad Estratégica**. 3. **Acción Concreta**. Usa Markdown. DATOS CLAVE: {datos_clave_str} ÁREAS DE INTERÉS: {', '.join(opciones_analisis)}"""
-                    respuesta_ia = model.generate_content(prompt_oportunidad)
-                    st.markdown(respuesta_ia.text)
+                    prompt_oportunidad = f"""DATOS CLAVE: {datos_clave_str} ÁREAS DE INTERÉS: {', '.join(opciones_analisis)}"""
+                    st.write_stream(transmitir_texto(obtener_modelo_con_instrucciones(INSTRUCCIONES_OPORTUNIDADES).generate_content(prompt_oportunidad, stream=True)))
                 except Exception as e:
                     st.error(f"No se pudo generar el análisis de oportunidades: {e}")
 
@@ -260,27 +461,11 @@ with tab_asesor:
                 else:
                     with st.spinner("Analizando tus rasgos... 🧐"):
                         try:
-                            prompt_parts = [
-                                """
-                                Actúa como un estilista de élite y experto en visagismo masculino. Tu cliente te ha mostrado una foto para que le des una asesoría de imagen completa.
-                                
-                                **Tu Tarea (formato Markdown):**
-                                1.  **Diagnóstico del Rostro:** Primero, identifica la forma del rostro (ej. Ovalado, Cuadrado, Redondo, etc.).
-                                2.  **Recomendaciones de Cortes (Top 3):**
-                                    - **Nombre del Estilo:** (ej. Pompadour Clásico, Buzz Cut, Quiff Texturizado).
-                                    - **¿Por qué te favorece?:** Explica brevemente cómo el corte complementa la forma del rostro.
-                                    - **Nivel de Mantenimiento:** (Bajo, Medio, Alto).
-                                    - **Productos Recomendados:** Sugiere un tipo de producto ideal (ej. Cera mate, pomada base agua, spray de sal marina).
-                                    - **Inspiración Visual:** Proporciona un enlace de búsqueda de Google Images para que el cliente vea ejemplos. Usa el formato: `[Ver Ejemplos](https://www.google.com/search?q=...&tbm=isch)`
-                                
-                                Sé profesional, alentador y específico en tus recomendaciones.
-                                """,
-                                image,
-                            ]
-                            response = model.generate_content(prompt_parts)
+                            prompt_parts = ["Esta es la foto de tu cliente:", preparar_imagen_para_ia(image)]
+                            response = obtener_modelo_con_instrucciones(INSTRUCCIONES_ASESOR).generate_content(prompt_parts, stream=True)
                             st.divider()
                             st.markdown("### 💈 Mis recomendaciones para ti:")
-                            st.markdown(response.text)
+                            st.write_stream(transmitir_texto(response))
                             st.link_button("📅 ¡Reserva tu cita ahora!", "http://localhost:3000", type="primary")
                         except Exception as e:
                             st.error("¡Oops! Ocurrió un error al analizar la imagen.")
@@ -63,7 +63,7 @@ def crear_graficos(df):
 
     # --- Gráfico 1: Top 5 Barberos por Ingresos ---
     try:
-        top_barberos = df.groupby('Nombre_Completo_Barbero')['Precio'].sum().nlargest(5)
+        top_barberos = df.groupby('Nombre_Completo_Barbero', observed=True)['Precio'].sum().nlargest(5)
         if not top_barberos.empty:
             # (Código del gráfico sin cambios...)
             buffer = io.BytesIO()
@@ -82,7 +82,7 @@ def crear_graficos(df):
 
     # --- Gráfico 2: Distribución de Ingresos por Servicio ---
     try:
-        ingresos_servicio = df.groupby('Nombre_Servicio')['Precio'].sum()
+        ingresos_servicio = df.groupby('Nombre_Servicio', observed=True)['Precio'].sum()
         if not ingresos_servicio.empty:
             # (Código del gráfico sin cambios...)
             buffer = io.BytesIO()
@@ -105,9 +105,9 @@ def crear_graficos(df):
 
     # --- NUEVO Gráfico 3: Horas Pico de Citas ---
     try:
-        # Aseguramos que la columna 'Fecha' sea datetime
-        df['Fecha'] = pd.to_datetime(df['Fecha'])
-        citas_por_hora = df['Fecha'].dt.hour.value_counts().sort_index()
+        # Aseguramos que 'Fecha' sea datetime en una Serie local, sin modificar el df recibido
+        fechas = pd.to_datetime(df['Fecha'])
+        citas_por_hora = fechas.dt.hour.value_counts().sort_index()
         if not citas_por_hora.empty:
             buffer = io.BytesIO()
             fig, ax = plt.subplots(figsize=(10, 5))
@@ -126,8 +126,8 @@ def crear_graficos(df):
 
     return graficos
 
-# --- FUNCIÓN PRINCIPAL (CON LA NUEVA TABLA DE DATOS) ---
-def generar_pdf_reporte(df, analisis_ia, contexto_reporte):
+# --- ESQUELETO DEL REPORTE: portada, KPIs y tabla (no dependen del análisis de IA) ---
+def generar_pdf_reporte_base(df, contexto_reporte):
     pdf = PDF()
     pdf.add_page()
     pdf.set_text_color(0, 0, 0)
@@ -152,7 +152,7 @@ def generar_pdf_reporte(df, analisis_ia, contexto_reporte):
     # --- NUEVA TABLA DE RESUMEN ---
     if not df.empty:
         pdf.section_title('Resumen de Rendimiento por Servicio')
-        df_servicio_resumen = df.groupby('Nombre_Servicio').agg(
+        df_servicio_resumen = df.groupby('Nombre_Servicio', observed=True).agg(
             Citas_Totales=('Nombre_Servicio', 'count'),
             Ingresos_Totales=('Precio', 'sum')
         ).sort_values(by='Ingresos_Totales', ascending=False).reset_index()
@@ -187,6 +187,10 @@ def generar_pdf_reporte(df, analisis_ia, contexto_reporte):
         pdf.write_html(html_tabla_styled)
         pdf.ln(10)
 
+    return pdf
+
+# --- CIERRE DEL REPORTE: análisis de IA y página de gráficos ---
+def completar_pdf_reporte(pdf, df, analisis_ia, graficos=None):
     pdf.section_title('Análisis y Recomendaciones de IA')
     pdf.set_text_color(0, 0, 0)
     analisis_ia_compatible = analisis_ia.encode('latin-1', 'replace').decode('latin-1')
@@ -198,7 +202,9 @@ def generar_pdf_reporte(df, analisis_ia, contexto_reporte):
     if not df.empty:
         pdf.add_page()
         pdf.section_title('Visualización de Datos')
-        graficos = crear_graficos(df.copy())
+        # Los gráficos pueden llegar ya generados (en paralelo con la consulta a la IA)
+        if graficos is None:
+            graficos = crear_graficos(df)
 
         if not graficos:
             pdf.cell(0, 10, "No se pudieron generar visualizaciones.", 0, 1)
@@ -218,4 +224,9 @@ def generar_pdf_reporte(df, analisis_ia, contexto_reporte):
                 pdf.image(graficos['citas_hora'], w=pdf.w - 30, x=15)
                 pdf.ln(5)
 
-    return bytes(pdf.output())
\ No newline at end of file
+    return bytes(pdf.output())
+
+# --- FUNCIÓN PRINCIPAL (CON LA NUEVA TABLA DE DATOS) ---
+def generar_pdf_reporte(df, analisis_ia, contexto_reporte, graficos=None):
+    pdf = generar_pdf_reporte_base(df, contexto_reporte)
+    return completar_pdf_reporte(pdf, df, analisis_ia, graficos)
\ No newline at end of file